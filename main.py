@@ -1,14 +1,34 @@
 import os
+import sys
 import re
 import asyncio
+import threading
 import time
 import json
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
 import mimetypes
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, send_from_directory
+import random
+from urllib.parse import quote
+from collections import deque
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import NamedTuple, Optional
+import orjson
+from flask import Flask, Response, request, jsonify, send_from_directory, abort
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.security import safe_join
 from flask_cors import CORS
-from telethon import TelegramClient, events
+from telethon import TelegramClient
 from telethon.sessions import StringSession
+from telethon.errors import RPCError, ServerError
+from telethon.tl.types import InputPeerUser
+
+try:
+    import uvloop
+except ImportError:  # uvloop no existe en Windows: se usa el loop estándar de asyncio
+    uvloop = None
 
 # --- Configuración y Variables de Entorno ---
 API_ID = int(os.getenv("API_ID", "0"))
@@ -16,8 +36,15 @@ API_HASH = os.getenv("API_HASH", "")
 PUBLIC_URL = os.getenv("PUBLIC_URL", "https://bankend-tlgm-2p.fly.dev").rstrip("/")
 SESSION_STRING = os.getenv("SESSION_STRING", None)
 PORT = int(os.getenv("PORT", 8080))
-
-DOWNLOAD_DIR = "downloads"
+# Solo activar detrás de un proxy que entienda X-Sendfile
+USE_X_SENDFILE = os.getenv("USE_X_SENDFILE", "").lower() in ("1", "true")
+# Prefijo de una location "internal" de nginx que apunta a DOWNLOAD_DIR (p. ej. /_internal_files)
+FILES_ACCEL_PREFIX = os.getenv("FILES_ACCEL_PREFIX", "").rstrip("/")
+if USE_X_SENDFILE and FILES_ACCEL_PREFIX:
+    raise RuntimeError("USE_X_SENDFILE y FILES_ACCEL_PREFIX son excluyentes: configure solo uno")
+
+# Ruta absoluta: send_from_directory resolvería una relativa contra app.root_path, no contra el CWD
+DOWNLOAD_DIR = os.path.abspath("downloads")
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
 LEDERDATA_BOT_ID = "@LEDERDATA_OFC_BOT" 
@@ -25,144 +52,348 @@ LEDERDATA_BACKUP_BOT_ID = "@lederdata_publico_bot"
 
 TIMEOUT_PRIMARY = 30  
 TIMEOUT_BACKUP = 40   
-BOT_BLOCK_HOURS = 3   
+ALL_BOT_IDS = (LEDERDATA_BOT_ID, LEDERDATA_BACKUP_BOT_ID)
+BOT_TIMEOUTS = {LEDERDATA_BOT_ID: TIMEOUT_PRIMARY, LEDERDATA_BACKUP_BOT_ID: TIMEOUT_BACKUP}
+SILENCE_SECONDS = 4.0
+TIMEOUT_TOTAL = 170  # por debajo del --timeout 180 de gunicorn
+# Vida de los adjuntos en DOWNLOAD_DIR: pasado este tiempo sus URLs de /files responden 404
+FILE_MAX_AGE_SECONDS = int(os.getenv("FILE_MAX_AGE_SECONDS", 24 * 3600))
+CLEANUP_INTERVAL_SECONDS = 60
+
+BOT_FAIL_THRESHOLD = 3  # fallos dentro de la ventana antes de abrir el circuito
+BOT_FAIL_WINDOW_SECONDS = 120  # fallos más antiguos que esto no cuentan para abrirlo
+BOT_COOLDOWN_SECONDS = 300  # tiempo con el circuito abierto antes de la consulta de prueba
+BOT_LOCK_WAIT_SECONDS = 10  # espera máxima por el turno de un bot antes de pasar al siguiente
+SEND_RETRIES = 3  # intentos de envío ante cortes de red o errores 5xx de Telegram
+SEND_RETRY_BASE_SECONDS = 0.5
+
+# --- Logging ---
+# Los hilos de petición solo encolan el registro; un hilo aparte lo formatea y escribe en stdout
+_LOG_QUEUE: queue.Queue = queue.Queue(-1)
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_LOG_LISTENER = QueueListener(_LOG_QUEUE, _log_stream)
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)
+
+log = logging.getLogger("bankend")
+# En producción LOG_LEVEL=WARNING descarta los mensajes informativos de cada consulta
+log.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+log.addHandler(QueueHandler(_LOG_QUEUE))
+log.propagate = False
+
+# Candados por bot para no solapar conversaciones en el cliente compartido
+_BOT_LOCKS: dict[str, asyncio.Lock] = {}
+
+# InputPeer de cada bot (ID + access_hash, inmutables para la cuenta), compartidos entre peticiones
+_BOT_PEER_CACHE: dict[str, InputPeerUser] = {}
+
+# Reglas por comando: parámetro de la query, longitudes admitidas y mensaje de error
+class ParamSpec(NamedTuple):
+    """Regla de validación del parámetro de un comando."""
+    arg: str
+    min_len: int
+    max_len: Optional[int]
+    error: str
+
+    def validate(self, value: Optional[str]) -> bool:
+        return bool(value) and len(value) >= self.min_len and (self.max_len is None or len(value) <= self.max_len)
+
+_DNI_RULE = ParamSpec("dni", 8, 8, "DNI inválido")
+_COMMAND_PARAMS = {
+    "cla": _DNI_RULE,
+    "afp": _DNI_RULE,
+    "bdir": ParamSpec("direccion", 9, None, "Dirección muy corta"),
+    "pasaporte": ParamSpec("pasaporte", 5, None, "Pasaporte inválido"),
+    "cedula": ParamSpec("cedula", 7, None, "Cédula inválida"),
+    "dend": _DNI_RULE,
+    "dence": ParamSpec("ce", 6, 12, "CE inválido"),
+    "denpas": ParamSpec("pasaporte", 6, 12, "Pasaporte inválido"),
+    "denci": ParamSpec("ci", 6, 12, "CI inválida"),
+    "denp": ParamSpec("placa", 5, 7, "Placa inválida"),
+    "denar": ParamSpec("serie", 5, 13, "Serie inválida"),
+    "dencl": ParamSpec("clave", 5, 11, "Clave inválida"),
+    "cafp": _DNI_RULE,
+    "sbs": _DNI_RULE,
+}
+
+# --- Patrones precompilados (evita la búsqueda en la caché de `re` por llamada) ---
+# Patrón de "No encontrado" solicitado y aviso anti-spam, evaluados en una sola pasada
+_RE_STATUS = re.compile(
+    r"(?P<not_found>\[⚠️\]\s*(?:no se encontro información|no se han encontrado resultados|no se encontró una|no hay resultados|no tenemos datos|no se encontraron registros))"
+    r"|(?P<anti_spam>ANTI-SPAM)",
+    re.IGNORECASE,
+)
+_RE_BOT_TAGS = re.compile(r"\[#?LEDER_BOT\]|\[CONSULTA PE\]", re.IGNORECASE)
+_RE_HEADER = re.compile(r"^\[.*?\]\s*→\s*.*?\[.*?\](?:\r?\n){1,2}", re.IGNORECASE | re.DOTALL)
+# Marcadores de pie que descartan todo lo que sigue: basta ubicar el primero y cortar
+# Sin prefijo \s*: evita reintentos cuadráticos en rachas de espacios (el strip final los quita)
+_RE_FOOTER_CUT = re.compile(r"Página\s*\d+/\d+|Credits\s*:.|@lederdata", re.IGNORECASE | re.DOTALL)
+# Restos del pie que solo se eliminan en su lugar (sin grupos de captura)
+_RE_FOOTER = re.compile(r"(?:\r?\n){1,2}\[|Créditos\s*:\s*\d+", re.IGNORECASE)
+_RE_SEPARATOR = re.compile(r"-{3,}")
+
+# --- Circuit breaker por bot ---
+class BotBreaker:
+    """Cerrado → abierto tras BOT_FAIL_THRESHOLD fallos en la ventana → semiabierto tras BOT_COOLDOWN_SECONDS."""
+    __slots__ = ("state", "failures", "opened_at")
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures: deque[float] = deque(maxlen=BOT_FAIL_THRESHOLD)  # instantes de los últimos fallos
+        self.opened_at = None
+
+    def is_open(self) -> bool:
+        """Consulta de solo lectura: True si el bot está bloqueado, sin consumir la prueba."""
+        return self.state != "closed" and time.monotonic() - self.opened_at < BOT_COOLDOWN_SECONDS
+
+    def allow(self) -> bool:
+        if self.state == "closed": return True
+        if self.is_open(): return False
+        # Semiabierto: pasa una sola consulta de prueba; si nunca informa resultado,
+        # el enfriamiento reiniciado vuelve a habilitar otra prueba más adelante
+        self.state = "half_open"
+        self.opened_at = time.monotonic()
+        return True
+
+    def on_success(self):
+        self.state = "closed"
+        self.failures.clear()
 
-# Rastreador de fallos para bloqueo de 3 horas
-bot_fail_tracker = {}
+    def on_failure(self):
+        now = time.monotonic()
+        # Ventana deslizante: solo cuentan los fallos de los últimos BOT_FAIL_WINDOW_SECONDS
+        self.failures.append(now)
+        while now - self.failures[0] > BOT_FAIL_WINDOW_SECONDS: self.failures.popleft()
+        # Ya abierto: fallos tardíos de consultas en curso no reinician el enfriamiento
+        if self.state == "open": return
+        if self.state == "half_open" or len(self.failures) >= BOT_FAIL_THRESHOLD:
+            self.state = "open"
+            self.opened_at = now
+
+bot_breakers = {bot_id: BotBreaker() for bot_id in ALL_BOT_IDS}
 
 # --- Funciones de Utilidad ---
 def is_bot_blocked(bot_id: str) -> bool:
-    last_fail_time = bot_fail_tracker.get(bot_id)
-    if not last_fail_time: return False
-    if datetime.now() < last_fail_time + timedelta(hours=BOT_BLOCK_HOURS):
-        return True
-    return False
+    """Consulta el breaker del bot sin modificarlo (no consume el intento semiabierto)."""
+    return bot_breakers[bot_id].is_open()
+
+def acquire_bot(bot_id: str) -> bool:
+    """Autoriza una consulta al bot; si está semiabierto, consume el intento de prueba."""
+    return bot_breakers[bot_id].allow()
 
 def record_bot_failure(bot_id: str):
-    bot_fail_tracker[bot_id] = datetime.now()
+    bot_breakers[bot_id].on_failure()
+
+def record_bot_success(bot_id: str):
+    bot_breakers[bot_id].on_success()
 
 def analyze_content(text: str):
     """Analiza el contenido de los mensajes para determinar el estado de la respuesta."""
-    # Patrón de "No encontrado" solicitado
-    not_found_pattern = r"\[⚠️\]\s*(no se encontro información|no se han encontrado resultados|no se encontró una|no hay resultados|no tenemos datos|no se encontraron registros)"
-    
-    if re.search(not_found_pattern, text, re.IGNORECASE | re.DOTALL):
-        return "NOT_FOUND"
-    
-    if "⛔ ANTI-SPAM" in text.upper() or "ANTI-SPAM" in text.upper():
-        return "ANTI_SPAM"
-        
-    return "SUCCESS"
+    if not text: return "SUCCESS"
+
+    # Sin el emoji de aviso ni un guion no puede haber "no encontrado" ni "ANTI-SPAM"
+    if "⚠" not in text and "-" not in text:
+        return "SUCCESS"
+
+    status = "SUCCESS"
+    for match in _RE_STATUS.finditer(text):
+        # "No encontrado" tiene prioridad sobre el anti-spam
+        if match.lastgroup == "not_found":
+            return "NOT_FOUND"
+        status = "ANTI_SPAM"
+    return status
 
 def clean_text(raw_text: str):
     """Limpieza estándar de publicidad/headers manteniendo la lógica original."""
     if not raw_text: return ""
     text = raw_text
-    text = re.sub(r"\[#?LEDER_BOT\]|\[CONSULTA PE\]", "", text, flags=re.IGNORECASE)
-    header_pattern = r"^\[.*?\]\s*→\s*.*?\[.*?\](\r?\n){1,2}"
-    text = re.sub(header_pattern, "", text, flags=re.IGNORECASE | re.DOTALL)
-    footer_pattern = r"((\r?\n){1,2}\[|Página\s*\d+\/\d+.*|Credits\s*:.+|\s*@lederdata.*|Créditos\s*:\s*\d+)"
-    text = re.sub(footer_pattern, "", text, flags=re.IGNORECASE | re.DOTALL)
-    text = re.sub(r"\-{3,}", "", text).strip()
-    return text
+    # Cada regex solo se ejecuta si aparece su texto clave (búsqueda de subcadena en C)
+    if "[" in text:
+        text = _RE_BOT_TAGS.sub("", text)
+        if text.startswith("[") and "→" in text: text = _RE_HEADER.sub("", text)
+    lowered = text.lower()
+    if "página" in lowered or "credits" in lowered or "@lederdata" in lowered:
+        footer = _RE_FOOTER_CUT.search(text)
+        if footer: text = text[:footer.start()]
+    if "\n[" in text or "créditos" in lowered:
+        text = _RE_FOOTER.sub("", text)
+    if "---" in text: text = _RE_SEPARATOR.sub("", text)
+    return text.strip()
+
+def get_command_and_param(command_name: str, request_args):
+    """Valida el parámetro del comando con una sola búsqueda en la tabla de reglas."""
+    spec = _COMMAND_PARAMS[command_name]
+    value = request_args.get(spec.arg)
+    if not spec.validate(value): return None, spec.error
+    return f"/{command_name} {value}", None
 
 # --- Lógica de Interacción con Telegram ---
+# Telethon no admite cambiar de event loop tras conectar: el cliente compartido vive en un
+# loop dedicado que corre en su propio hilo durante toda la vida del proceso.
+_BG_LOOP = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+threading.Thread(target=_BG_LOOP.run_forever, name="telegram-loop", daemon=True).start()
+
+_GLOBAL_CLIENT: Optional[TelegramClient] = None
+_GLOBAL_CLIENT_LOCK = asyncio.Lock()
+
+async def get_client() -> TelegramClient:
+    """Devuelve el cliente compartido, creándolo y conectándolo de forma perezosa."""
+    global _GLOBAL_CLIENT
+    if _GLOBAL_CLIENT is not None and _GLOBAL_CLIENT.is_connected():
+        return _GLOBAL_CLIENT
+    async with _GLOBAL_CLIENT_LOCK:
+        if _GLOBAL_CLIENT is None:
+            if not SESSION_STRING: raise Exception("SESSION_STRING no configurada")
+            _GLOBAL_CLIENT = TelegramClient(StringSession(SESSION_STRING), API_ID, API_HASH)
+        if not _GLOBAL_CLIENT.is_connected():
+            await _GLOBAL_CLIENT.connect()
+            # La autorización se verifica una vez por conexión, no en cada consulta
+            if not await _GLOBAL_CLIENT.is_user_authorized():
+                await _GLOBAL_CLIENT.disconnect()
+                raise Exception("La sesión de Telegram no está autorizada")
+        return _GLOBAL_CLIENT
+
+async def resolve_bot_peer(client, bot_id: str) -> InputPeerUser:
+    """Devuelve el InputPeer del bot, resolviéndolo en Telegram solo la primera vez."""
+    peer = _BOT_PEER_CACHE.get(bot_id)
+    if peer is None:
+        peer = _BOT_PEER_CACHE[bot_id] = await client.get_input_entity(bot_id)
+    return peer
+
+async def send_with_retry(conv, command):
+    """Envía el comando reintentando fallos transitorios con backoff exponencial y jitter."""
+    for attempt in range(1, SEND_RETRIES + 1):
+        try:
+            return await conv.send_message(command)
+        except (ConnectionError, ServerError) as e:
+            if attempt == SEND_RETRIES: raise
+            delay = SEND_RETRY_BASE_SECONDS * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            log.warning("Envío fallido (%s). Reintentando en %.2fs.", e, delay)
+            await asyncio.sleep(delay)
+
 async def query_bot(client, bot_id, command, timeout):
-    """Envía un comando a un bot específico y espera la respuesta consolidada."""
-    all_messages = []
-    last_msg_time = [time.time()]
-    
-    @client.on(events.NewMessage(incoming=True, from_users=bot_id))
-    async def handler(event):
-        last_msg_time[0] = time.time()
-        all_messages.append(event.message)
+    """Envía un comando a un bot y devuelve (mensajes, descargas), o None si no llegó a consultarse."""
+    all_messages, downloads = [], []
+    bot_peer = await resolve_bot_peer(client, bot_id)
 
+    # Las conversaciones de Telethon son exclusivas por chat: una consulta por bot a la vez.
+    # La espera del turno está acotada para no encadenar timeouts detrás de un bot caído.
+    lock = _BOT_LOCKS.setdefault(bot_id, asyncio.Lock())
     try:
-        await client.send_message(bot_id, command)
-        start_time = time.time()
-        
-        # Espera de hasta 'timeout' segundos
-        while True:
-            elapsed = time.time() - start_time
-            silence = time.time() - last_msg_time[0]
-            
-            # Si ya hay mensajes y hay silencio de 4 segundos, asumimos que terminó
-            if len(all_messages) > 0 and silence > 4.0:
-                break
-            # Si excedemos el timeout total
-            if elapsed > timeout:
-                break
-            await asyncio.sleep(0.5)
-            
-        return all_messages
+        await asyncio.wait_for(lock.acquire(), BOT_LOCK_WAIT_SECONDS)
+    except asyncio.TimeoutError:
+        return None
+
+    try:
+        # Con el turno tomado se revisa el breaker: los fallos de la cola pudieron abrirlo,
+        # y si está semiabierto aquí se consume la única consulta de prueba
+        if not acquire_bot(bot_id): return None
+        # La conversación solo recibe mensajes del chat del bot (sin handler ni filtro manual)
+        async with client.conversation(bot_peer, timeout=SILENCE_SECONDS, total_timeout=timeout) as conv:
+            await send_with_retry(conv, command)
+            try:
+                # Espera de hasta 'timeout' segundos por el primer mensaje
+                msg = await conv.get_response(timeout=timeout)
+                # Si hay silencio de 4 segundos, asumimos que terminó
+                while True:
+                    all_messages.append(msg)
+                    # El adjunto se descarga mientras se espera el resto de la respuesta
+                    if msg.media: downloads.append(asyncio.create_task(download_file(client, msg)))
+                    msg = await conv.get_response()
+            except asyncio.TimeoutError:
+                pass
+    except BaseException:
+        for task in downloads: task.cancel()
+        raise
     finally:
-        client.remove_event_handler(handler)
+        lock.release()
+
+    return all_messages, downloads
+
+# Tipos que envían los bots: se resuelven sin recorrer las tablas de mimetypes
+_EXT_BY_MIME = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "application/pdf": ".pdf",
+    "video/mp4": ".mp4",
+}
+
+async def download_file(client, msg):
+    """Descarga el adjunto de un mensaje en DOWNLOAD_DIR y devuelve la ruta local."""
+    mime_type = getattr(msg.file, "mime_type", None)
+    if mime_type is None: ext = ".jpg"
+    else: ext = _EXT_BY_MIME.get(mime_type) or mimetypes.guess_extension(mime_type)
+    fname = f"file_{msg.id}{ext or '.dat'}"
+    return await client.download_media(msg, file=os.path.join(DOWNLOAD_DIR, fname))
 
 async def send_telegram_command(command: str):
-    client = None
+    # 1. BOTS DISPONIBLES: con todos los circuitos abiertos se responde sin tocar Telegram
+    bots_to_try = [bot_id for bot_id in ALL_BOT_IDS if not is_bot_blocked(bot_id)]
+    if not bots_to_try:
+        return {"status": "error", "message": "Todos los bots están temporalmente bloqueados."}
+
     try:
-        if not SESSION_STRING: raise Exception("SESSION_STRING no configurada")
-        
-        client = TelegramClient(StringSession(SESSION_STRING), API_ID, API_HASH)
-        await client.connect()
-
-        final_response_messages = []
-        use_backup = False
-
-        # 1. INTENTO CON BOT PRINCIPAL
-        if not is_bot_blocked(LEDERDATA_BOT_ID):
-            print(f"--- Consultando Bot Principal: {LEDERDATA_BOT_ID} ---")
-            primary_msgs = await query_bot(client, LEDERDATA_BOT_ID, command, TIMEOUT_PRIMARY)
-            
-            if not primary_msgs:
-                print("Bot principal no respondió. Bloqueando por 3 horas.")
-                record_bot_failure(LEDERDATA_BOT_ID)
-                use_backup = True
-            else:
-                full_text = "\n".join([m.text for m in primary_msgs if m.text])
-                status = analyze_content(full_text)
-                
-                if status == "NOT_FOUND":
-                    return {"status": "error", "message": "No se encontraron resultados."}
-                elif status == "ANTI_SPAM":
-                    print("Anti-spam detectado en principal. Pasando a respaldo.")
-                    use_backup = True
-                else:
-                    final_response_messages = primary_msgs
-        else:
-            print("Bot principal bloqueado temporalmente. Usando respaldo directamente.")
-            use_backup = True
-
-        # 2. INTENTO CON BOT DE RESPALDO (SI CORRESPONDE)
-        if use_backup:
-            print(f"--- Consultando Bot Respaldo: {LEDERDATA_BACKUP_BOT_ID} ---")
-            backup_msgs = await query_bot(client, LEDERDATA_BACKUP_BOT_ID, command, TIMEOUT_BACKUP)
-            
-            if not backup_msgs:
-                return {"status": "error", "message": "Ningún bot respondió a la consulta."}
-            
-            full_text_backup = "\n".join([m.text for m in backup_msgs if m.text])
-            if analyze_content(full_text_backup) == "NOT_FOUND":
+        client = await get_client()
+
+        # 2. INTENTOS EN ORDEN (PRINCIPAL → RESPALDO)
+        final_response_messages, final_downloads, busy = None, None, False
+        for i, bot_id in enumerate(bots_to_try):
+            # Un fallo de una consulta anterior pudo abrir el circuito después del filtro inicial
+            if is_bot_blocked(bot_id): continue
+            log.info("--- Consultando Bot: %s ---", bot_id)
+            try:
+                result = await query_bot(client, bot_id, command, BOT_TIMEOUTS[bot_id])
+            except (RPCError, ConnectionError) as e:
+                # FloodWait largo u otro error de Telegram: se cuenta como fallo y se prueba el respaldo
+                log.warning("Error consultando %s: %s", bot_id, e)
+                record_bot_failure(bot_id)
+                continue
+
+            if result is None:
+                # Sin turno o con el circuito abierto: no es un fallo del bot, se prueba el siguiente
+                log.info("Bot %s ocupado o bloqueado. Pasando al siguiente bot.", bot_id)
+                busy = True
+                continue
+            msgs, downloads = result
+
+            if not msgs:
+                log.warning("Bot %s no respondió. Fallo registrado en el circuit breaker.", bot_id)
+                record_bot_failure(bot_id)
+                continue
+
+            record_bot_success(bot_id)
+            status = analyze_content("\n".join([m.text for m in msgs if m.text]))
+
+            # El anti-spam del último bot disponible se devuelve tal cual, como antes
+            is_last = all(is_bot_blocked(b) for b in bots_to_try[i + 1:])
+            if status == "SUCCESS" or (status == "ANTI_SPAM" and is_last):
+                final_response_messages, final_downloads = msgs, downloads
+                break
+
+            # Respuesta descartada: sus adjuntos ya no se necesitan
+            for task in downloads: task.cancel()
+            if status == "NOT_FOUND":
                 return {"status": "error", "message": "No se encontraron resultados."}
-            
-            final_response_messages = backup_msgs
+            log.info("Anti-spam detectado en %s. Pasando al siguiente bot.", bot_id)
+
+        if final_response_messages is None:
+            if busy: return {"status": "error", "message": "Los bots están ocupados. Intenta nuevamente."}
+            return {"status": "error", "message": "Ningún bot respondió a la consulta."}
 
         # 3. PROCESAMIENTO FINAL DE RESULTADOS
-        consolidated_text = ""
-        file_urls = []
+        # Extraer texto limpio (un único join en lugar de concatenaciones sucesivas)
+        consolidated_text = "\n".join(clean_text(msg.text) for msg in final_response_messages if msg.text)
 
-        for msg in final_response_messages:
-            # Extraer texto limpio
-            if msg.text:
-                consolidated_text += clean_text(msg.text) + "\n"
-            
-            # Procesar archivos adjuntos
-            if msg.media:
-                ext = mimetypes.guess_extension(msg.file.mime_type) if hasattr(msg.file, 'mime_type') else '.jpg'
-                fname = f"file_{msg.id}{ext or '.dat'}"
-                path = await client.download_media(msg, file=os.path.join(DOWNLOAD_DIR, fname))
-                if path:
-                    file_urls.append({"url": f"{PUBLIC_URL}/files/{os.path.basename(path)}"})
+        # Procesar archivos adjuntos: las descargas arrancaron al recibir cada mensaje
+        paths = await asyncio.gather(*final_downloads, return_exceptions=True)
+        file_urls = []
+        for path in paths:
+            if isinstance(path, Exception):
+                log.warning("Error descargando adjunto: %s", path)
+            elif path:
+                file_urls.append({"url": f"{PUBLIC_URL}/files/{os.path.basename(path)}"})
 
         return {
             "status": "success",
@@ -172,112 +403,128 @@ async def send_telegram_command(command: str):
 
     except Exception as e:
         return {"status": "error", "message": str(e)}
-    finally:
-        if client: await client.disconnect()
+
+async def warm_up():
+    """Conecta el cliente y resuelve los bots antes de recibir tráfico."""
+    try:
+        start = time.monotonic()
+        client = await get_client()
+        # get_me deja en caché el usuario propio que Telethon consulta al enviar y recibir
+        await client.get_me(input_peer=True)
+        connected = time.monotonic()
+        for bot_id in ALL_BOT_IDS:
+            await resolve_bot_peer(client, bot_id)
+        log.info(
+            "Cliente de Telegram conectado en %.2fs y bots resueltos en %.2fs.",
+            connected - start, time.monotonic() - connected,
+        )
+    except Exception as e:
+        log.error("Error preparando el cliente de Telegram: %s", e)
+
+if SESSION_STRING: asyncio.run_coroutine_threadsafe(warm_up(), _BG_LOOP)
+
+# --- Limpieza de descargas en segundo plano ---
+def purge_old_files(max_age: float) -> int:
+    """Elimina de DOWNLOAD_DIR los archivos más antiguos que `max_age` segundos."""
+    cutoff = time.time() - max_age
+    removed = 0
+    # scandir entrega DirEntry con stat cacheado: una syscall por archivo en lugar de varias
+    with os.scandir(DOWNLOAD_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
+
+async def cleanup_loop():
+    """Barre DOWNLOAD_DIR periódicamente fuera del camino de las peticiones."""
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
+        try:
+            removed = await asyncio.to_thread(purge_old_files, FILE_MAX_AGE_SECONDS)
+            if removed: log.info("Limpiados %d archivos antiguos.", removed)
+        except Exception as e:
+            log.error("Error limpiando descargas: %s", e)
+
+asyncio.run_coroutine_threadsafe(cleanup_loop(), _BG_LOOP)
 
 # --- Flask App ---
+class ORJSONProvider(DefaultJSONProvider):
+    """Proveedor JSON de Flask basado en orjson: `jsonify` emite bytes UTF-8 directamente."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# Los archivos no cambian tras descargarse: caché del cliente hasta que el barrido los elimine
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = FILE_MAX_AGE_SECONDS
+app.config["USE_X_SENDFILE"] = USE_X_SENDFILE
 CORS(app)
 
 def run_cmd(cmd):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try: return loop.run_until_complete(send_telegram_command(cmd))
-    finally: loop.close()
+    # Se despacha al loop persistente: el cliente compartido solo puede usarse desde ese loop
+    future = asyncio.run_coroutine_threadsafe(send_telegram_command(cmd), _BG_LOOP)
+    try:
+        return future.result(timeout=TIMEOUT_TOTAL)
+    except FutureTimeoutError:
+        future.cancel()
+        return {"status": "error", "message": "Tiempo de espera agotado."}
+
+def handle_command(command_name):
+    command, error = get_command_and_param(command_name, request.args)
+    if error: return jsonify({"error": error}), 400
+    return jsonify(run_cmd(command))
 
 @app.route("/files/<path:filename>")
 def get_file(filename):
+    if FILES_ACCEL_PREFIX:
+        # nginx sirve el archivo con sendfile; Flask solo valida la ruta y responde la cabecera
+        path = safe_join(DOWNLOAD_DIR, filename)
+        if path is None or not os.path.isfile(path): abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        # La cabecera es una URI: espacios, '%', '?', '#' o no-ASCII deben ir codificados
+        resp = Response(headers={"X-Accel-Redirect": f"{FILES_ACCEL_PREFIX}/{quote(filename)}"}, mimetype=mimetype)
+        # Misma caché de cliente que aplica send_from_directory
+        resp.cache_control.public = True
+        resp.cache_control.max_age = FILE_MAX_AGE_SECONDS
+        return resp
     return send_from_directory(DOWNLOAD_DIR, filename)
 
 # --- ENDPOINTS (Mantenidos intactos) ---
-
-@app.route("/cla", methods=["GET"])
-def cla():
-    dni = request.args.get("dni")
-    if not dni or len(dni) != 8: return jsonify({"error": "DNI inválido"}), 400
-    return jsonify(run_cmd(f"/cla {dni}"))
-
-@app.route("/afp", methods=["GET"])
-def afp():
-    dni = request.args.get("dni")
-    if not dni or len(dni) != 8: return jsonify({"error": "DNI inválido"}), 400
-    return jsonify(run_cmd(f"/afp {dni}"))
-
-@app.route("/bdir", methods=["GET"])
-def bdir():
-    dir_query = request.args.get("direccion")
-    if not dir_query or len(dir_query) < 9: return jsonify({"error": "Dirección muy corta"}), 400
-    return jsonify(run_cmd(f"/bdir {dir_query}"))
-
-@app.route("/pasaporte", methods=["GET"])
-def pasaporte():
-    pass_num = request.args.get("pasaporte")
-    if not pass_num or len(pass_num) < 5: return jsonify({"error": "Pasaporte inválido"}), 400
-    return jsonify(run_cmd(f"/pasaporte {pass_num}"))
-
-@app.route("/cedula", methods=["GET"])
-def cedula():
-    ce = request.args.get("cedula")
-    if not ce or len(ce) < 7: return jsonify({"error": "Cédula inválida"}), 400
-    return jsonify(run_cmd(f"/cedula {ce}"))
-
-@app.route("/dend", methods=["GET"])
-def dend():
-    dni = request.args.get("dni")
-    if not dni or len(dni) != 8: return jsonify({"error": "DNI inválido"}), 400
-    return jsonify(run_cmd(f"/dend {dni}"))
-
-@app.route("/dence", methods=["GET"])
-def dence():
-    ce = request.args.get("ce")
-    if not ce or not (6 <= len(ce) <= 12): return jsonify({"error": "CE inválido"}), 400
-    return jsonify(run_cmd(f"/dence {ce}"))
-
-@app.route("/denpas", methods=["GET"])
-def denpas():
-    pass_num = request.args.get("pasaporte")
-    if not pass_num or not (6 <= len(pass_num) <= 12): return jsonify({"error": "Pasaporte inválido"}), 400
-    return jsonify(run_cmd(f"/denpas {pass_num}"))
-
-@app.route("/denci", methods=["GET"])
-def denci():
-    ci = request.args.get("ci")
-    if not ci or not (6 <= len(ci) <= 12): return jsonify({"error": "CI inválida"}), 400
-    return jsonify(run_cmd(f"/denci {ci}"))
-
-@app.route("/denp", methods=["GET"])
-def denp():
-    placa = request.args.get("placa")
-    if not placa or not (5 <= len(placa) <= 7): return jsonify({"error": "Placa inválida"}), 400
-    return jsonify(run_cmd(f"/denp {placa}"))
-
-@app.route("/denar", methods=["GET"])
-def denar():
-    serie = request.args.get("serie")
-    if not serie or not (5 <= len(serie) <= 13): return jsonify({"error": "Serie inválida"}), 400
-    return jsonify(run_cmd(f"/denar {serie}"))
-
-@app.route("/dencl", methods=["GET"])
-def dencl():
-    clave = request.args.get("clave")
-    if not clave or not (5 <= len(clave) <= 11): return jsonify({"error": "Clave inválida"}), 400
-    return jsonify(run_cmd(f"/dencl {clave}"))
-
-@app.route("/cafp", methods=["GET"])
-def cafp():
-    dni = request.args.get("dni")
-    if not dni or len(dni) != 8: return jsonify({"error": "DNI inválido"}), 400
-    return jsonify(run_cmd(f"/cafp {dni}"))
-
-@app.route("/sbs", methods=["GET"])
-def sbs():
-    dni = request.args.get("dni")
-    if not dni or len(dni) != 8: return jsonify({"error": "DNI inválido"}), 400
-    return jsonify(run_cmd(f"/sbs {dni}"))
+# Una sola regla dinámica para todos los comandos: las rutas estáticas ("/", "/files/...")
+# siguen teniendo prioridad en el enrutador. La regla acepta cualquier método para que un
+# nombre desconocido responda 404 con todos ellos (como una ruta no registrada) y un comando
+# válido con un método distinto de GET siga respondiendo 405, como las rutas individuales.
+_COMMAND_METHODS = ["GET", "HEAD", "OPTIONS"]
+
+@app.route(
+    "/<command_name>",
+    methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
+    provide_automatic_options=False,
+)
+def command_endpoint(command_name):
+    if command_name not in _COMMAND_PARAMS: abort(404)
+    if request.method == "OPTIONS": return Response(headers={"Allow": ", ".join(_COMMAND_METHODS)})
+    if request.method not in _COMMAND_METHODS: abort(405, valid_methods=_COMMAND_METHODS)
+    return handle_command(command_name)
+
+# Cuerpo constante serializado una sola vez; cada petición recibe su propio Response
+_ROOT_BODY = orjson.dumps({"status": "API Active", "version": "6.1"})
 
 @app.route("/")
 def root():
-    return jsonify({"status": "API Active", "version": "6.1"})
+    return Response(_ROOT_BODY, mimetype="application/json")
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=PORT)